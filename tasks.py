@@ -27,16 +27,24 @@ import os
 import sys
 import glob
 import shutil
+import subprocess
 
 import yaml
-import jinja2
 
 from copy import deepcopy
-from functools import reduce
+from collections import deque
+from functools import reduce, lru_cache, partial
 from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
 
 from invoke import Collection, task, run
 
+# Prefer the libyaml based loader when PyYAML has been built with it.
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 
 #
 # Global definitions
@@ -90,9 +98,45 @@ class msg(object):
         FATAL:       ('XX', sys.stderr),
     }
 
+    # Informative levels, their continuation lines use the _CONTINUE
+    # prefix.
+    _INFO_LEVELS = _NOPREFIX | _CONTINUE | REQUEST | INFORMATION
+
+    # Resolve, for each level, the prefix of the first line, the one of
+    # the continuation lines and the stream of the whole message. Message
+    # upper than INFORMATION level should be visible to the user so the
+    # prefix for those messages is kept on every line. A message is kept
+    # on a single stream so that its lines can't be interleaved.
+    #
+    # Levels are single bits, the table is indexed by their bit length.
+    # Index 0 holds the entry used for unknown levels.
+    _resolved = [None] * (FATAL.bit_length() + 1)
+    for _lvl, (_prefix, _stream) in _levels.items():
+        _resolved[_lvl.bit_length()] = (
+            _prefix,
+            _levels[_CONTINUE][0] if _lvl & _INFO_LEVELS else _prefix,
+            _stream,
+        )
+    _resolved[0] = _resolved[_NOPREFIX.bit_length()]
+    _resolved = tuple(_resolved)
+    del _lvl, _prefix, _stream
 
-    @classmethod
-    def write(cls, level, *lines):
+    # Text put in front of the request in ask().
+    _REQUEST_PREFIX = _levels[REQUEST][0] + ' '
+
+    # Answers accepted by ask_yn().
+    _YES = frozenset(('y', 'yes', 't', 'true', '1'))
+    _NO  = frozenset(('n', 'no', 'f', 'false', '0'))
+
+    # Options shown by ask_yn() depending on the default answer.
+    _YN_OPTS = {None: '[y/n]', True: '[Y/n]', False: '[y/N]'}
+
+
+    # Class attributes are bound as defaults so that they are read as
+    # local variables on every call.
+    @staticmethod
+    def write(level, *lines, _resolved=_resolved,
+              _error=ERROR.bit_length()):
         """Print *lines* to the standard output at given *level*.
 
         :param int level: Level of the message to be printed. Allowed
@@ -107,19 +151,21 @@ class msg(object):
         :param str lines: Lines to be printed on screen.
 
         """
-        prefix, stream = cls._levels.get(
-            level, cls._levels[cls._NOPREFIX]
-        )
-        c_prefix, c_stream = prefix, stream
-        # Message upper than INFORMATION level should be visible to
-        # the user so the prefix for those messages is kept.
-        if level < cls.WARNING:
-            c_prefix, c_stream = cls._levels[cls._CONTINUE]
+        # Only single bit levels known to the table have an entry, any
+        # other value is printed without prefix.
+        index = level.bit_length()
+        if level & (level - 1) or index >= len(_resolved):
+            index = 0
+        prefix, c_prefix, stream = _resolved[index]
+
+        # Assemble the message to issue a single write.
+        head = '{} {}\n'.format(prefix, lines[0])
+        tail = ''.join('{} {}\n'.format(c_prefix, l) for l in lines[1:])
+        stream.write(head + tail)
 
-        lines = list(lines)
-        print(prefix, lines.pop(0), sep=' ', file=stream)
-        for l in lines:
-            print(c_prefix, l, sep=' ', file=c_stream)
+        # Errors must reach the user even if the task dies right after.
+        if index >= _error:
+            stream.flush()
 
 
     @classmethod
@@ -149,13 +195,10 @@ class msg(object):
         :rtype: str
 
         """
-        lines   = list(lines)
-        request = '{prefix} {message} '.format(
-            prefix=cls._levels[cls.REQUEST][0], message=lines.pop()
-        )
+        request = '{}{} '.format(cls._REQUEST_PREFIX, lines[-1])
 
-        if lines and not kwargs.get('request_only', False):
-            cls.write(cls.REQUEST, *lines)
+        if len(lines) > 1 and not kwargs.get('request_only', False):
+            cls.write(cls.REQUEST, *lines[:-1])
         return input(request)
 
 
@@ -190,36 +233,45 @@ class msg(object):
         :rtype: bool or None
 
         """
-        valid_yes_re = re.compile(r'y|yes|t|true|1', re.IGNORECASE)
-        valid_no_re  = re.compile(r'n|no|f|false|0', re.IGNORECASE)
-        max_try = 2
+        max_try = 3
 
         # Prepare available options based on expected default answer.
         default = kwargs.get('default')
-        opts = '[y/n]'
-        if default is True:
-            opts = '[Y/n]'
-        elif default is False:
-            opts = '[y/N]'
+        opts    = cls._YN_OPTS.get(default, cls._YN_OPTS[None])
 
         # Add options to the request.
-        lines = list(lines)
-        lines.append(
-            '{message} {opts}'.format(message=lines.pop(), opts=opts)
-        )
+        info     = lines[:-1]
+        question = '{} {}'.format(lines[-1], opts)
 
-        answer = cls.ask(*lines)
-        while max_try != 0:
-            if valid_yes_re.match(answer):
-                return True
-            elif valid_no_re.match(answer):
-                return False
+        # Information lines are only printed with the first request.
+        for attempt in range(max_try):
+            answer = cls._classify_yn(
+                cls.ask(*info, question, request_only=attempt > 0)
+            )
+            if answer is not None:
+                return answer
             elif default is not None:
                 return default
 
-            answer   = cls.ask(*lines, request_only=True)
-            max_try -= 1
+        return None
+
+
+    @classmethod
+    def _classify_yn(cls, answer):
+        """Tell whether *answer* is a *yes* or a *no*.
+
+        :param str answer: Answer as entered by the user.
+
+        :returns: ``True`` for *yes*, ``False`` for *no* and ``None``
+                  if *answer* is neither.
+        :rtype: bool or None
 
+        """
+        answer = answer.strip().lower()
+        if answer in cls._YES:
+            return True
+        elif answer in cls._NO:
+            return False
         return None
 
 
@@ -228,39 +280,134 @@ class msg(object):
 # ^^^^^^^^^^^
 
 class fs(object):
-    """Namespace for filesystem related operations."""
+    """Namespace for filesystem related operations.
 
-    @staticmethod
-    def shexpand(pattern):
+    :attribute COPYTREE_WORKERS_ENV: Environment variable giving the
+                                     default number of threads used by
+                                     :meth:`fs.copytree`.
+
+    """
+    COPYTREE_WORKERS_ENV = 'PROPANELIB_COPYTREE_WORKERS'
+
+    # Can directories be removed relative to an open directory?
+    _RMDIR_AT = hasattr(os, 'fwalk') and os.rmdir in os.supports_dir_fd
+
+
+    @classmethod
+    def shexpand(cls, pattern):
         """Return a possibly-empty list of path names that match
         *pattern*.
 
+        Expansions are remembered, call :meth:`fs.shexpand_cache_clear`
+        once the filesystem may have changed.
+
         :param pattern: A string or a list of strings containing
                         shell-style wildcards.
         :type pattern: str or iterable
 
-        :returns: A list of path names matching given *pattern*.
+        :returns: A list of path names matching given *pattern*. A path
+                  matched by several patterns is only listed once.
         :rtype: list
 
+        """
+        if isinstance(pattern, (str, bytes)):
+            return list(cls._shexpand_one(pattern))
+
+        # Keep the order of the matches while dropping duplicates.
+        matches = (item for x in pattern for item in cls._shexpand_one(x))
+        return list(dict.fromkeys(matches))
+
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _shexpand_one(pattern):
+        """Memoized expansion of a single *pattern* for
+        :meth:`fs.shexpand`.
+
+        """
+        return tuple(glob.iglob(fs._expand(pattern)))
+
+
+    @classmethod
+    def shexpand_cache_clear(cls):
+        """Forget about expansions remembered by :meth:`fs.shexpand`."""
+        cls._shexpand_one.cache_clear()
+
+
+    @staticmethod
+    def shiexpand(pattern):
+        """Iterate over the path names that match *pattern*.
+
+        Same as :meth:`fs.shexpand` but matches are yielded one at a
+        time instead of being gathered in a list first. Expansions are
+        not remembered.
+
+        :param pattern: A string or a list of strings containing
+                        shell-style wildcards.
+        :type pattern: str or iterable
+
         """
         if isinstance(pattern, (str, bytes)):
             it = [pattern, ]
         else:
             it = pattern
 
-        def _expand(x):
-            return glob.glob(os.path.expanduser(os.path.expandvars(x)))
+        for x in it:
+            yield from glob.iglob(fs._expand(x))
+
+
+    @staticmethod
+    def _expand(pattern):
+        """Expand environment variables and user home directory in
+        *pattern*. Patterns with neither ``$`` nor ``~`` are returned as
+        is.
+
+        """
+        pattern = os.fspath(pattern)
+        if isinstance(pattern, bytes):
+            expand = b'$' in pattern or b'~' in pattern
+        else:
+            expand = '$' in pattern or '~' in pattern
 
-        # Flatten list of paths from _expand.
-        return [
-            item
-            for paths_list in map(_expand, it)
-            for item in paths_list
-        ]
+        if expand:
+            return os.path.expanduser(os.path.expandvars(pattern))
+        return pattern
 
 
     @staticmethod
-    def copytree(src, dst):
+    def _iter_subdirs(src):
+        """Iterate over the directories found in the tree of *src*.
+        Paths are relative to *src* and a directory is always yielded
+        before its content. Symbolic links to directories are yielded
+        but not followed.
+
+        :param src: Path of the directory tree to walk.
+        :type src: str or bytes
+
+        """
+        # Start from an empty path of the same type as src, str or bytes.
+        stack = [src[:0], ]
+        while stack:
+            rel = stack.pop()
+            try:
+                # DirEntry caches the file type read with the directory
+                # listing, no extra stat is required.
+                with os.scandir(os.path.join(src, rel)) as it:
+                    entries = [
+                        (e.name, e.is_symlink()) for e in it if e.is_dir()
+                    ]
+            except OSError:
+                continue
+
+            for name, is_link in entries:
+                sub = os.path.join(rel, name)
+                yield sub
+                if not is_link:
+                    stack.append(sub)
+
+
+    @classmethod
+    def copytree(cls, src, dst, workers=None):
         """Copy the directory tree structure from *src* to recreate it
         in the *dst* directory.
 
@@ -270,19 +417,96 @@ class fs(object):
         :param str dst: Path to the destination directory to replicate
                         the directory tree structure.
 
+        :param int workers: Number of threads used to create the
+                            directories. Defaults to the value of the
+                            ``PROPANELIB_COPYTREE_WORKERS`` environment
+                            variable or to ``1``, creating directories
+                            sequentially, if not set.
+
         """
+        if workers is None:
+            workers = 1
+            with suppress(ValueError):
+                workers = int(os.environ.get(cls.COPYTREE_WORKERS_ENV, 1))
+
+        # On Windows, robocopy mirrors a directory skeleton in a single
+        # native process. Exit codes lower than 8 report a success.
+        if sys.platform == 'win32' and shutil.which('robocopy'):
+            with suppress(OSError):
+                rc = subprocess.call(
+                    ['robocopy', src, dst, '/E', '/XF', '*', '/XJ',
+                     '/NFL', '/NDL', '/NJH', '/NJS', '/NP'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+                if rc < 8:
+                    return
+
         os.makedirs(dst, exist_ok=True)
-        for root, dirs, _ in os.walk(src):
-            for d in dirs:
-                os.makedirs(
-                    os.path.join(root.replace(src, dst), d),
-                    exist_ok=True
+
+        if workers <= 1:
+            # Parents are created before their content, os.mkdir() is
+            # enough.
+            for rel in cls._iter_subdirs(src):
+                with suppress(FileExistsError):
+                    os.mkdir(os.path.join(dst, rel))
+            return
+
+        subdirs = [os.path.join(dst, rel) for rel in cls._iter_subdirs(src)]
+
+        # os.makedirs() creates missing parents, only leaves are needed.
+        parents = {os.path.dirname(d) for d in subdirs}
+        targets = [d for d in subdirs if d not in parents]
+
+        def _makedirs(path):
+            os.makedirs(path, exist_ok=True)
+
+        # Directory creation is bound by system call latency, let the
+        # calls overlap.
+        cls._fanout(_makedirs, targets, workers)
+
+
+    @staticmethod
+    def fastcopytree(src, dst):
+        """Copy the directory tree *src*, files included, to *dst*.
+        Same as :func:`shutil.copytree` but the platform's native copy
+        tool is used when available: ``robocopy`` on Windows and
+        ``cp --reflink=auto`` on Linux, sharing data blocks where the
+        filesystem allows it.
+
+        :param str src: Path to the directory tree to copy.
+        :param str dst: Path to the destination, it must not already
+                        exist.
+
+        """
+        cmd = None
+        if sys.platform == 'win32':
+            cmd = ['robocopy', src, dst, '/MT:64', '/E',
+                   '/NFL', '/NDL', '/NJH', '/NJS', '/NP']
+        elif sys.platform.startswith('linux'):
+            cmd = ['cp', '-a', '--reflink=auto', src, dst]
+
+        if cmd and not os.path.lexists(dst) and shutil.which(cmd[0]):
+            with suppress(OSError):
+                parent = os.path.dirname(dst)
+                if parent:
+                    os.makedirs(parent, exist_ok=True)
+
+                rc = subprocess.call(
+                    cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
                 )
+                # Exit codes of robocopy lower than 8 report a success.
+                if rc == 0 or (cmd[0] == 'robocopy' and rc < 8):
+                    return
+
+            # Don't let a partial copy get in the way.
+            shutil.rmtree(dst, ignore_errors=True)
+
+        shutil.copytree(src, dst)
 
 
     @classmethod
     def lstree(cls, pattern, recursive=False, include_path=False):
-        """List all files and directories found in given path.
+        """Iterate over all files and directories found in given path.
 
         :param iterable pattern: A string or list of strings containing
                                  shell-style patterns of directories to
@@ -293,25 +517,206 @@ class fs(object):
                                Default to **False**.
 
         :param bool include_path: Should given ``path`` also be included
-                                  in returned list.
+                                  in returned items.
+
+        """
+        for path in cls.shiexpand(pattern):
+            stack = [path, ]
+            while stack:
+                top = stack.pop()
+                try:
+                    # DirEntry.path is already joined and is_dir() reuses
+                    # the file type read with the directory listing.
+                    with os.scandir(top) as it:
+                        entries = [
+                            (e.path, e.is_dir(follow_symlinks=False))
+                            for e in it
+                        ]
+                except OSError:
+                    continue
+
+                if top is path and include_path:
+                    yield path
+
+                for entry, is_dir in entries:
+                    yield entry
+                    if recursive and is_dir:
+                        stack.append(entry)
+
+
+    @classmethod
+    def lstree_list(cls, pattern, recursive=False, include_path=False):
+        """List all files and directories found in given path.
+
+        Same as :meth:`fs.lstree` but items are gathered in a list.
 
         :returns: A list of items found in given path.
         :rtype: list
 
         """
-        lst = []
-        for path in cls.shexpand(pattern):
-            for root, dirs, files in os.walk(path):
-                if root == path and include_path:
-                    lst.append(root)
+        return list(cls.lstree(pattern, recursive, include_path))
 
-                lst += map(lambda x: os.path.join(root, x), dirs)
-                lst += map(lambda x: os.path.join(root, x), files)
 
-                if not recursive:
-                    break
+    @staticmethod
+    def _roots(paths):
+        """Return given *paths* sorted and without duplicates, leaving
+        out the ones nested in another path from *paths*.
+
+        Paths are only normalized to be compared, the returned ones are
+        left untouched as normalizing ``link/../dir`` would not point to
+        the same location when ``link`` is a symbolic link.
+
+        :param iterable paths: Paths to be filtered.
+
+        :returns: A sorted list of the top-most paths.
+        :rtype: list
+
+        """
+        def _components(path):
+            sep = os.sep.encode() if isinstance(path, bytes) else os.sep
+            return path.split(sep)
+
+        originals = {}
+        for path in paths:
+            originals.setdefault(os.path.normpath(path), path)
+
+        roots = []
+        last = None
+        # Sorting on path components keeps sub-paths right after their
+        # parent.
+        for key in sorted(originals, key=_components):
+            if last is not None:
+                # Joining an empty component adds the trailing separator
+                # of the path's own type when missing.
+                if key.startswith(os.path.join(last, last[:0])):
+                    continue
+            last = key
+            roots.append(originals[key])
+
+        return roots
+
+
+    @staticmethod
+    def _fanout(func, paths, workers=32):
+        """Call *func* on each of the given *paths*, using a pool of
+        threads when more than one path is given.
 
-        return lst
+        :param func func: Function to be called with each path.
+        :param list paths: Independent paths to be processed.
+        :param int workers: Maximum number of threads to be used.
+                            Defaults to 32.
+
+        """
+        if workers > 1 and len(paths) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(workers, len(paths))
+            ) as executor:
+                list(executor.map(func, paths))
+        else:
+            for path in paths:
+                func(path)
+
+
+    @classmethod
+    def _rmdir_empty(cls, path, removed=None):
+        """Remove directory *path* if it is empty once its own empty
+        subdirectories have been removed. Directories holding anything
+        else are left in place without trying to remove them.
+
+        :param str path: Path of the directory tree to clean.
+        :param list removed: If given, removed directories are appended
+                             to this list, deepest first.
+
+        :returns: ``True`` if *path* has been removed, ``False``
+                  otherwise.
+        :rtype: bool
+
+        """
+        # A symbolic link to a directory is not walked through, neither
+        # as a subdirectory nor as the top directory.
+        if os.path.islink(path):
+            return False
+
+        if cls._RMDIR_AT:
+            return cls._rmdir_empty_at(path, removed)
+
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return False
+
+        empty = True
+        for e in entries:
+            # Any subdirectory has to be cleaned, even when we already
+            # know this one will be kept.
+            if not e.is_dir(follow_symlinks=False) \
+               or not cls._rmdir_empty(e.path, removed):
+                empty = False
+
+        if not empty:
+            return False
+
+        try:
+            os.rmdir(path)
+        except OSError:
+            return False
+
+        if removed is not None:
+            removed.append(path)
+        return True
+
+
+    @staticmethod
+    def _rmdir_empty_at(path, removed=None):
+        """Same as :meth:`fs._rmdir_empty` but subdirectories are
+        removed relative to their parent's file descriptor, sparing a
+        full path lookup for each of them.
+
+        """
+        walked = False
+        kept = set()
+        walk = os.fwalk(path, topdown=False)
+        while True:
+            try:
+                root, dirs, files, root_fd = next(walk)
+            except StopIteration:
+                break
+            except OSError:
+                # Top directory could not be opened.
+                return False
+
+            walked = True
+            if files:
+                kept.add(root)
+
+            # Subdirectories have all been visited at this point.
+            for d in dirs:
+                sub_path = os.path.join(root, d)
+                if sub_path in kept:
+                    kept.add(root)
+                    continue
+
+                try:
+                    os.rmdir(d, dir_fd=root_fd)
+                except OSError:
+                    kept.add(root)
+                    continue
+
+                if removed is not None:
+                    removed.append(sub_path)
+
+        if not walked or path in kept:
+            return False
+
+        try:
+            os.rmdir(path)
+        except OSError:
+            return False
+
+        if removed is not None:
+            removed.append(path)
+        return True
 
 
     @classmethod
@@ -328,17 +733,40 @@ class fs(object):
                                empty directories found in the tree?
 
         """
-        for path in sorted(cls.shexpand(pattern)):
-            if recursive:
-                # Remove empty directories in tree from deepest to
-                # shallowest.
-                for root, dirs, _ in os.walk(path, topdown=False):
-                    for d in dirs:
-                        with suppress(OSError):
-                            os.rmdir(os.path.join(root, d))
+        if recursive:
+            cls.clean_tree(pattern)
+            return
 
+        for path in sorted(set(cls.shiexpand(pattern))):
             with suppress(OSError):
                 os.rmdir(path)
+        cls.shexpand_cache_clear()
+
+
+    @classmethod
+    def clean_tree(cls, pattern):
+        """Remove any empty directory found in the directory trees
+        matching *pattern*, including the trees' root, in a single walk.
+
+        :param iterable pattern: A string or list of strings containing
+                                 shell-style patterns of directories to
+                                 clean.
+
+        :returns: Removed directories, deepest first within each tree.
+        :rtype: list
+
+        """
+        removed = []
+
+        def _clean(path):
+            cls._rmdir_empty(path, removed)
+
+        # Separate trees can be processed concurrently. Nested trees are
+        # already walked through with their parent.
+        cls._fanout(_clean, cls._roots(cls.shiexpand(pattern)))
+        cls.shexpand_cache_clear()
+
+        return removed
 
 
     @classmethod
@@ -351,19 +779,37 @@ class fs(object):
                                  remove.
 
         """
-        for path in sorted(cls.shexpand(pattern)):
-            # Avoid two removal tries if path does not exist.
-            if not os.path.lexists(path):
-                continue
+        def _rmtree(path):
+            def _onexc(func, sub_path, exc):
+                # Another tree being removed concurrently may have
+                # already taken care of this sub-path.
+                if sub_path == path \
+                   or not isinstance(exc, FileNotFoundError):
+                    raise exc
+
+            def _onerror(func, sub_path, exc_info):
+                _onexc(func, sub_path, exc_info[1])
+
+            # onerror is deprecated since Python 3.12 in favour of onexc,
+            # which is given the exception itself.
+            if sys.version_info >= (3, 12):
+                handler = {'onexc': _onexc}
+            else:
+                handler = {'onerror': _onerror}
 
             try:
                 # Try to remove path (and sub-paths) as a directory.
-                shutil.rmtree(path)
+                shutil.rmtree(path, **handler)
             except OSError:
                 # Not a directory, try to remove path as a file.
                 with suppress(OSError):
                     os.remove(path)
 
+        # The filesystem may have changed since the last expansion, don't
+        # remove anything based on a remembered one.
+        cls._fanout(_rmtree, cls._roots(cls.shiexpand(pattern)))
+        cls.shexpand_cache_clear()
+
 
     @classmethod
     def symlink(cls, source, link_name, force=False, target_is_directory=False):
@@ -386,30 +832,105 @@ class fs(object):
 
         """
         with suppress(OSError):
-            if os.readlink(link_name) == source \
-               or os.path.abspath(os.readlink(link_name)) == source:
+            existing = os.readlink(link_name)
+            if existing == source or os.path.abspath(existing) == source:
                 return True
 
-        if force:
-            if os.path.lexists(link_name):
-                cls.rmtree(link_name)
-            else:
-                try:
-                    os.makedirs(link_name, exist_ok=True)
-                except OSError:
-                    return False
-                cls.rmdir(link_name)
+        if not force:
+            try:
+                os.symlink(
+                    source, link_name, target_is_directory=target_is_directory
+                )
+            except (NotImplementedError, OSError):
+                return False
+            return True
+
+        # Make sure the directory holding the link exists.
+        parent = os.path.dirname(link_name)
+        try:
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+        except OSError:
+            return False
 
+        # Create the link aside then move it over link_name, which is
+        # atomically replaced.
+        tmp_name = '{}.tmp.{}'.format(link_name, os.getpid())
         try:
             os.symlink(
-                source, link_name, target_is_directory=target_is_directory
+                source, tmp_name, target_is_directory=target_is_directory
             )
         except (NotImplementedError, OSError):
             return False
 
+        try:
+            try:
+                os.replace(tmp_name, link_name)
+            except OSError:
+                # A directory can not be replaced, remove it first.
+                cls.rmtree(link_name)
+                os.replace(tmp_name, link_name)
+        except OSError:
+            with suppress(OSError):
+                os.remove(tmp_name)
+            return False
+
         return True
 
 
+class afs(object):
+    """Namespace for asynchronous filesystem operations.
+
+    Operations are run in the default executor of the event loop so
+    that a batch of them can be awaited concurrently::
+
+      >>> loop = asyncio.get_event_loop()
+      >>> loop.run_until_complete(
+      ...     asyncio.gather(*[afs.makedirs(p) for p in targets])
+      ... )
+
+    """
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        """Run *func* with given arguments in the default executor."""
+        # Only needed by coroutines, don't load it for other tasks.
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+    @classmethod
+    async def makedirs(cls, path):
+        """Asynchronous :func:`os.makedirs`, existing *path* is not an
+        error.
+
+        """
+        await cls._run(os.makedirs, path, exist_ok=True)
+
+
+    @classmethod
+    async def readlink(cls, path):
+        """Asynchronous :func:`os.readlink`."""
+        return await cls._run(os.readlink, path)
+
+
+    @classmethod
+    async def symlink(cls, source, link_name, target_is_directory=False):
+        """Asynchronous :func:`os.symlink`."""
+        await cls._run(
+            os.symlink, source, link_name,
+            target_is_directory=target_is_directory
+        )
+
+
+    @classmethod
+    async def rmdir(cls, path):
+        """Asynchronous :func:`os.rmdir`."""
+        await cls._run(os.rmdir, path)
+
+
 #
 # Docstring
 # ^^^^^^^^^
@@ -430,6 +951,27 @@ class docstring(object):
     EXT_RST = '.rst'
 
 
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _patterns(marker):
+        """Compile the regular expressions matching docstrings starting
+        with *marker*. Patterns are compiled once for a given *marker*.
+
+        :param str marker: Docstring comment line identifier.
+
+        :returns: A pattern matching *marker* along with the white space
+                  following it and a pattern matching a whole, possibly
+                  indented, docstring line.
+        :rtype: tuple
+
+        """
+        marker = re.escape(marker)
+        return (
+            re.compile(r'{}\s?'.format(marker)),
+            re.compile(r'^[^\S\n]*{}.*$'.format(marker), re.M),
+        )
+
+
     @classmethod
     def extract(cls, path, dst, insert_code=False):
         """Extract specially formatted comment strings (a.k.a.
@@ -451,50 +993,62 @@ class docstring(object):
         :rtype: bool
 
         """
-        docstring_start_re = re.compile(
-            r'{}\s?'.format(cls.DOCSTRING_START_WITH)
-        )
+        ds_re, line_re = cls._patterns(cls.DOCSTRING_START_WITH)
 
         doclines = []
         doc_app  = doclines.append
         with suppress(OSError), open(path, 'r') as fd:
-            code_block = False
-
-            for line in fd:
-                # Strip line to get the comment symbol on first position.
-                sline = line.strip()
-
-                # Start by looking if we have a docstring.
-                if sline.startswith(cls.DOCSTRING_START_WITH):
-                    # Insert blank line between previous code block
-                    # and next docstring line.
-                    if code_block:
-                        doc_app('\n')
-                        code_block = False
-
-                    ds_line = docstring_start_re.sub('', sline)
-                    doc_app('{}\n'.format(ds_line))
-
-                # If this is a blank line and we are not writing code
-                # or if this is a comment line, skip.
-                elif (not sline and not code_block) \
-                    or sline.startswith(cls.COMMENT_START_WITH):
-                    continue
-
-                # Any other lines should be code to be inserted.
-                elif insert_code:
-                    if not code_block:
-                        doc_app('.. code-block:: cf3\n\n')
-                        code_block = True
-                    doc_app(
-                        '{}{}\n'.format(
-                            ' ' * (cls.DOCSTRING_INDENT), line.rstrip()
+            if not insert_code:
+                # Only docstring lines are kept, look for all of them in
+                # a single pass over the file.
+                text = fd.read()
+                if cls.DOCSTRING_START_WITH in text:
+                    for m in line_re.finditer(text):
+                        ds_line = m.group().strip()
+                        doc_app(
+                            '{}\n'.format(ds_re.sub('', ds_line))
                         )
-                    )
+            else:
+                code_block = False
+
+                # Look attributes up once rather than on every line.
+                ds_start = cls.DOCSTRING_START_WITH
+                c_start  = cls.COMMENT_START_WITH
+                ds_sub   = ds_re.sub
+                indent   = ' ' * cls.DOCSTRING_INDENT
+
+                for line in fd:
+                    # Strip line to get the comment symbol on first
+                    # position.
+                    sline = line.strip()
+
+                    # Start by looking if we have a docstring.
+                    if sline.startswith(ds_start):
+                        # Insert blank line between previous code block
+                        # and next docstring line.
+                        if code_block:
+                            doc_app('\n')
+                            code_block = False
+
+                        ds_line = ds_sub('', sline)
+                        doc_app('{}\n'.format(ds_line))
+
+                    # If this is a blank line and we are not writing code
+                    # or if this is a comment line, skip.
+                    elif (not sline and not code_block) \
+                        or sline.startswith(c_start):
+                        continue
+
+                    # Any other lines should be code to be inserted.
+                    else:
+                        if not code_block:
+                            doc_app('.. code-block:: cf3\n\n')
+                            code_block = True
+                        doc_app('{}{}\n'.format(indent, line.rstrip()))
 
         if doclines:
             with suppress(OSError), open(dst, 'w') as fd:
-                fd.writelines(doclines)
+                fd.write(''.join(doclines))
                 return True
         return False
 
@@ -514,11 +1068,15 @@ class docstring(object):
                                  Defaults to ``False``.
 
         """
-        cf_files = [
-            (p, p.replace(src, dst).replace(cls.EXT_CF, cls.EXT_RST))
-            for p in sorted(fs.lstree(src, recursive=True))
+        def _dest(path):
+            rel = os.path.relpath(path, src)
+            return os.path.join(dst, rel[:-len(cls.EXT_CF)] + cls.EXT_RST)
+
+        cf_files = sorted(
+            (p, _dest(p))
+            for p in fs.lstree(src, recursive=True)
             if p.endswith(cls.EXT_CF) and not os.path.isdir(p)
-        ]
+        )
 
         if not cf_files:
             return
@@ -555,6 +1113,18 @@ class env(object):
         ENVIRONMENT_DEFAULTS['project']['build_d'], 'doc'
     )
 
+    # Types of the values which can be shared instead of being copied.
+    _SCALARS = (str, bytes, int, float, complex, bool, type(None))
+
+    # Delimiters opening Jinja2 blocks, variables and comments.
+    _TEMPLATE_MARKERS = (b'{%', b'{{', b'{#')
+
+    # Parsed YAML documents by path, modification time and size.
+    _YAML_CACHE = {}
+
+    # Jinja2 environments by source directories.
+    _ENGINES = {}
+
 
     @classmethod
     def dmap(cls, callback, *mapping, recurse=False):
@@ -573,13 +1143,24 @@ class env(object):
                              dictionaries? Defaults to ``False``.
 
         """
-        for m in mapping:
-            with suppress(AttributeError):
-                for k, v in tuple(m.items()):
-                    if recurse and isinstance(v, dict):
-                        cls.dmap(callback, v, recurse)
-                    else:
-                        callback(m, k, v)
+        # Walk through nested dictionaries with a stack rather than
+        # recursive calls. A mapping is put back on the stack below its
+        # child so that items are still visited in order.
+        stack = [(m, None) for m in reversed(mapping)]
+        while stack:
+            m, items = stack.pop()
+            if items is None:
+                try:
+                    items = iter(tuple(m.items()))
+                except AttributeError:
+                    continue
+
+            for k, v in items:
+                if recurse and isinstance(v, dict):
+                    stack.append((m, items))
+                    stack.append((v, None))
+                    break
+                callback(m, k, v)
 
 
     @classmethod
@@ -599,7 +1180,7 @@ class env(object):
         """
         environment = {}
         if use_defaults:
-            environment = cls.ENVIRONMENT_DEFAULTS.copy()
+            environment = cls._clone(cls.ENVIRONMENT_DEFAULTS)
 
         def _load_include(mapping, key, val):
             """Update given dictionary with given ``include`` directive
@@ -623,7 +1204,18 @@ class env(object):
             if key == 'include':
                 with suppress(KeyError):
                     del mapping[key]
-                cls.update(mapping, cls.load(val))
+
+                if isinstance(val, (str, bytes)):
+                    cls.update(mapping, cls.load(val), clone=False)
+                elif len(val) > 1:
+                    # Read and parse the included files concurrently but
+                    # merge them in the order they were given.
+                    with ThreadPoolExecutor(max_workers=8) as ex:
+                        cls.update(
+                            mapping, *ex.map(cls.load, val), clone=False
+                        )
+                else:
+                    cls.update(mapping, *map(cls.load, val), clone=False)
 
             # Try to look for inclue directives if list of dict.
             with suppress(TypeError):
@@ -632,18 +1224,43 @@ class env(object):
 
         # Defaults may have include directives.
         cls.dmap(_load_include, environment, recurse=True)
+
+        # An empty pattern can not match any file, don't glob for it.
+        pattern = [p for p in pattern if p]
+        if not pattern:
+            return environment
+
         for path in fs.shexpand(pattern):
-            loaded = {}
-            with open(path, 'r') as fp:
-                loaded = yaml.safe_load(fp)
-                cls.dmap(_load_include, loaded, recurse=True)
-            cls.update(environment, loaded)
+            loaded = cls._parse(path)
+            cls.dmap(_load_include, loaded, recurse=True)
+            cls.update(environment, loaded, clone=False)
 
         return environment
 
 
     @classmethod
-    def update(cls, target, *mapping):
+    def _parse(cls, path):
+        """Return a copy of the YAML document stored at *path*. A file is
+        only parsed again once it has been modified.
+
+        :param str path: Path to the YAML file.
+
+        """
+        st  = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        try:
+            document = cls._YAML_CACHE[key]
+        except KeyError:
+            with open(path, 'rb') as fp:
+                document = yaml.load(fp.read(), Loader=_YamlLoader)
+            cls._YAML_CACHE[key] = document
+
+        # Callers alter the document they get.
+        return cls._clone(document)
+
+
+    @classmethod
+    def update(cls, target, *mapping, clone=True):
         """Merge given target dictionary with given *mapping* object.
         Unlike Python's dict.update() method, if the same key is present
         in both dictionaries and the value for this key is a dictionary,
@@ -662,14 +1279,57 @@ class env(object):
         :param dict mapping: Dictionary to be merged. Multiple may be
                              given.
 
+        :param bool clone: Should values from *mapping* be copied into
+                           *target*? Set to ``False`` only when *mapping*
+                           is not used afterwards, its values are then
+                           shared with *target*. Defaults to ``True``.
+
         """
-        for m in mapping:
-            with suppress(AttributeError):
-                for k, v in tuple(m.items()):
-                    if k in target and isinstance(v, dict):
-                        cls.update(target[k], v)
-                    else:
-                        target[k] = deepcopy(v)
+        # Walk through nested dictionaries with a work list rather than
+        # recursive calls.
+        pending = deque((target, m) for m in mapping)
+        while pending:
+            t, m = pending.popleft()
+            try:
+                items = tuple(m.items())
+            except AttributeError:
+                continue
+
+            for k, v in items:
+                if isinstance(v, dict) and isinstance(t.get(k), dict):
+                    pending.append((t[k], v))
+                elif clone:
+                    t[k] = cls._clone(v)
+                else:
+                    t[k] = v
+
+
+    @classmethod
+    def _clone(cls, value):
+        """Return a deep copy of *value*.
+
+        Types produced by the YAML loader are copied directly, other
+        types are given to :func:`copy.deepcopy`. Immutable scalars are
+        returned as is.
+
+        :param value: Value to be copied.
+
+        """
+        if isinstance(value, cls._SCALARS):
+            return value
+
+        kind = type(value)
+        if kind is dict:
+            return {k: cls._clone(v) for k, v in value.items()}
+        elif kind is list:
+            return [cls._clone(v) for v in value]
+        elif kind is tuple:
+            return tuple(cls._clone(v) for v in value)
+        elif kind is set:
+            # Set items are hashable values, a shallow copy is enough.
+            return set(value)
+
+        return deepcopy(value)
 
 
     @classmethod
@@ -711,21 +1371,75 @@ class env(object):
                           ``dst/.`` while files from ``/path/to/bar``
                           will be in ``dst/bar``.
 
+        :returns: Sorted paths of the files written in *dst*.
+        :rtype: list
+
         """
+        engine  = cls._engine(src)
+        written = []
+
+        def _render(name):
+            prefix, _, rel = name.partition('/')
+            origin = os.path.join(src[prefix], rel)
+            target = os.path.join(dst, name)
+
+            # Only the directories holding a file are needed.
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            # Files without any Jinja2 syntax are copied as is.
+            with open(origin, 'rb') as fp:
+                data = fp.read()
+            if not any(m in data for m in cls._TEMPLATE_MARKERS):
+                shutil.copyfile(origin, target)
+            else:
+                with open(target, 'w') as fp:
+                    fp.write(engine.get_template(name).render(context))
+            written.append(target)
+
+        # Each file is written on its own, let reads and writes overlap.
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        fs._fanout(_render, engine.list_templates(), workers)
+
+        return sorted(written)
+
+
+    @classmethod
+    def _engine(cls, src):
+        """Return the Jinja2 environment rendering templates from *src*
+        directories. A single environment is created for given *src*
+        and compiled templates are cached on disk across builds.
+
+        :param dict src: Dictionary of source directories, see
+                         :meth:`env.render_tree`.
+
+        """
+        key = tuple(sorted(src.items()))
+        with suppress(KeyError):
+            return cls._ENGINES[key]
+
+        # Jinja2 is only needed to build, don't load it for other tasks.
+        import jinja2
+
+        cache_d = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'propanelib', 'jinja'
+        )
+        bytecode_cache = None
+        with suppress(OSError):
+            os.makedirs(cache_d, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_d)
+
         loader = {k: jinja2.FileSystemLoader(v) for k, v in src.items()}
         engine = jinja2.Environment(
             extensions = ['jinja2.ext.loopcontrols', ],
             loader = jinja2.PrefixLoader(loader),
             trim_blocks = True,
-            lstrip_blocks = True
+            lstrip_blocks = True,
+            bytecode_cache = bytecode_cache
         )
+        cls._ENGINES[key] = engine
 
-        for name, path in src.items():
-            fs.copytree(path, os.path.join(dst, name))
-
-        for name in engine.list_templates():
-            with open(os.path.join(dst, name), 'w') as fp:
-                fp.write(engine.get_template(name).render(context))
+        return engine
 
 
     @classmethod
@@ -756,6 +1470,8 @@ ENVIRONMENT = env.load('env.conf', use_defaults=True)
 @task(name='clean')
 def project_clean():
     """Clean project folder from built files."""
+    fs.shexpand_cache_clear()
+
     build_d   = ENVIRONMENT['project']['build_d']
     src_d     = ENVIRONMENT['project']['src_d']
     build_log = os.path.join(build_d, '.build')
@@ -772,6 +1488,18 @@ def project_clean():
                   'Cleaning project', *sorted(lines, reverse=True))
     fs.rmtree(patterns)
 
+    # Only files are logged, directories they left empty go as well, up
+    # to the build directory. Other outputs it may hold, such as the
+    # documentation's, are left alone.
+    top = os.path.normpath(build_d)
+    for path in {os.path.dirname(os.path.normpath(x)) for x in lines}:
+        while path == top or path.startswith(os.path.join(top, '')):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
 
 _proj_build_help = {
     'environment': "Project environment to be built. Defaults to {}.".format(
@@ -781,6 +1509,8 @@ _proj_build_help = {
 @task(project_clean, name='build', help=_proj_build_help)
 def project_build(environment=ENVIRONMENT.get('default_env', 'dev')):
     """Build the project."""
+    fs.shexpand_cache_clear()
+
     build_d   = ENVIRONMENT['project']['build_d']
     src_d     = ENVIRONMENT['project']['src_d']
     build_log = os.path.join(build_d, '.build')
@@ -805,14 +1535,8 @@ def project_build(environment=ENVIRONMENT.get('default_env', 'dev')):
         }
     env.update_context(ENVIRONMENT, context)
 
-    rendered = [
-        os.path.join(build_d, origine.replace(path, name))
-        for name, path in dirs.items()
-        for origine in fs.lstree(path, recursive=True)
-    ]
-
+    rendered = env.render_tree(context, dirs, build_d)
     msg.write(msg.INFORMATION, 'Building project', *rendered)
-    env.render_tree(context, dirs, build_d)
 
     with suppress(OSError), open(build_log, 'w') as fp:
         fp.write('\n'.join(rendered))
@@ -836,6 +1560,8 @@ ns.add_collection(ns_proj)
 @task(name='clean')
 def doc_clean():
     """Clean project folder from built documentation files."""
+    fs.shexpand_cache_clear()
+
     patterns = [ENVIRONMENT['doc']['build_d'], ]
 
     lines = [x for x in fs.shexpand(patterns)]
@@ -857,13 +1583,15 @@ _doc_build_help = {
 def doc_build(target=ENVIRONMENT['doc']['target'],
               code=ENVIRONMENT['doc']['insert_code']):
     """Build documentation using Sphinx."""
+    fs.shexpand_cache_clear()
+
     build_d = ENVIRONMENT['doc']['build_d']
     out_d   = os.path.join(build_d, 'output', target)
     src_d   = os.path.join(build_d, ENVIRONMENT['project']['src_d'])
 
     msg.write(msg.INFORMATION, 'Building documentation')
 
-    shutil.copytree(ENVIRONMENT['doc']['src_d'], build_d)
+    fs.fastcopytree(ENVIRONMENT['doc']['src_d'], build_d)
     docstring.to_dir(
         ENVIRONMENT['project']['src_d'],
         src_d,
@@ -901,22 +1629,18 @@ def build():
 @task(doc_clean, project_clean)
 def clean():
     """Clean the whole project tree from built files."""
+    fs.shexpand_cache_clear()
+
     patterns = [
         ENVIRONMENT['project']['build_d'],
     ]
 
-    lines = [
-        x
-        for x in fs.lstree(patterns, recursive=True, include_path=True)
-        if os.path.isdir(x)
-    ]
+    lines = fs.clean_tree(patterns)
     if lines:
         msg.write(msg.INFORMATION,
                   'Cleaning environment', *sorted(lines, reverse=True))
     msg.write(msg.INFORMATION, 'Done!')
 
-    fs.rmdir(patterns, recursive=True)
-
 
 ns.add_task(build)
 ns.add_task(clean)
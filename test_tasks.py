@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Tests for the filesystem helpers of the project's tasks."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from tasks import fs
+
+
+class TestRmdirEmpty(unittest.TestCase):
+    """Both implementations of :meth:`fs._rmdir_empty` must remove the
+    same directories.
+
+    """
+    IMPLEMENTATIONS = (False, True) if fs._RMDIR_AT else (False,)
+
+    def setUp(self):
+        self.tmp_d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_d)
+
+        self._rmdir_at = fs._RMDIR_AT
+        self.addCleanup(setattr, fs, '_RMDIR_AT', self._rmdir_at)
+
+    def _path(self, *parts):
+        return os.path.join(self.tmp_d, *parts)
+
+    def _implementations(self):
+        for rmdir_at in self.IMPLEMENTATIONS:
+            with self.subTest(rmdir_at=rmdir_at):
+                fs._RMDIR_AT = rmdir_at
+                yield
+
+    def test_empty_tree(self):
+        for _ in self._implementations():
+            os.makedirs(self._path('top', 'a', 'b'))
+            os.makedirs(self._path('top', 'c'))
+
+            removed = []
+            self.assertTrue(fs._rmdir_empty(self._path('top'), removed))
+            self.assertEqual(
+                sorted(removed),
+                sorted([self._path('top'), self._path('top', 'a'),
+                        self._path('top', 'a', 'b'), self._path('top', 'c')])
+            )
+            self.assertEqual(removed[-1], self._path('top'))
+            self.assertFalse(os.path.lexists(self._path('top')))
+
+    def test_kept_file(self):
+        for _ in self._implementations():
+            os.makedirs(self._path('top', 'a', 'b'))
+            os.makedirs(self._path('top', 'c'))
+            open(self._path('top', 'a', 'file'), 'w').close()
+
+            removed = []
+            self.assertFalse(fs._rmdir_empty(self._path('top'), removed))
+            self.assertEqual(
+                sorted(removed),
+                sorted([self._path('top', 'a', 'b'), self._path('top', 'c')])
+            )
+            self.assertTrue(os.path.isfile(self._path('top', 'a', 'file')))
+            shutil.rmtree(self._path('top'))
+
+    def test_symlinked_subdir(self):
+        for _ in self._implementations():
+            os.makedirs(self._path('target', 'empty'))
+            os.makedirs(self._path('top'))
+            os.symlink(self._path('target'), self._path('top', 'link'))
+
+            removed = []
+            self.assertFalse(fs._rmdir_empty(self._path('top'), removed))
+            self.assertEqual(removed, [])
+            self.assertTrue(os.path.islink(self._path('top', 'link')))
+            self.assertTrue(os.path.isdir(self._path('target', 'empty')))
+            shutil.rmtree(self._path('top'))
+            shutil.rmtree(self._path('target'))
+
+    def test_symlinked_root(self):
+        for _ in self._implementations():
+            os.makedirs(self._path('target', 'empty'))
+            os.symlink(self._path('target'), self._path('link'))
+
+            removed = []
+            self.assertFalse(fs._rmdir_empty(self._path('link'), removed))
+            self.assertEqual(removed, [])
+            self.assertTrue(os.path.islink(self._path('link')))
+            self.assertTrue(os.path.isdir(self._path('target', 'empty')))
+            os.remove(self._path('link'))
+            shutil.rmtree(self._path('target'))
+
+
+if __name__ == '__main__':
+    unittest.main()